@@ -23,60 +23,87 @@ import numpy as np
 import optax
 from datasets import load_dataset
 
+from flax import jax_utils
 from flax.experimental import nnx
 
 np.random.seed(42)
 latent_size = 32
-image_shape: tp.Sequence[int] = (28, 28)
+image_shape: tuple[int, ...] = (28, 28)
 steps_per_epoch: int = 200
 batch_size: int = 64
 epochs: int = 20
+# computation dtype, parameters are kept in float32
+dtype = jnp.bfloat16
+# the batch is split across all local devices
+n_devices = jax.local_device_count()
+assert batch_size % n_devices == 0, (
+  f'batch_size ({batch_size}) must be divisible by the number of local '
+  f'devices ({n_devices})'
+)
+device_batch_size = batch_size // n_devices
 
 
 dataset = load_dataset('mnist')
 X_train = np.array(np.stack(dataset['train']['image']), dtype=np.uint8)
 X_test = np.array(np.stack(dataset['test']['image']), dtype=np.uint8)
-# Now binarize data
-X_train = (X_train > 0).astype(jnp.float32)
-X_test = (X_test > 0).astype(jnp.float32)
+# Now binarize data, pixels stay uint8 and are cast inside the model, the
+# training set is binarized on device below
+X_test = (X_test > 0).astype(np.uint8)
 
 print('X_train:', X_train.shape, X_train.dtype)
 print('X_test:', X_test.shape, X_test.dtype)
 
+image_size = int(np.prod(image_shape))
+
+
+@jax.jit
+def binarize_and_pack(x: jax.Array) -> jax.Array:
+  # pack the binary pixels into bits, 8 pixels per byte
+  return jnp.packbits(x.reshape((-1, image_size)) > 0, axis=1)
+
 
-class Loss(nnx.Variable):
-  pass
+X_train_packed = binarize_and_pack(X_train)
+
+# move the training set to every device once, batches are gathered on device
+# so there are no per-step host-to-device copies to overlap with compute
+X_train_dev = jax_utils.replicate(X_train_packed)
 
 
 # %%
 class Encoder(nnx.Module):
   def __init__(self, din: int, dmid: int, dout: int, *, rngs: nnx.Rngs):
-    self.linear1 = nnx.Linear(din, dmid, rngs=rngs)
-    self.linear_mean = nnx.Linear(dmid, dout, rngs=rngs)
-    self.linear_std = nnx.Linear(dmid, dout, rngs=rngs)
-
-  def __call__(self, x: jax.Array, *, rngs: nnx.Rngs) -> jax.Array:
-    x = x.reshape((x.shape[0], -1))  # flatten
+    self.linear1 = nnx.Linear(din, dmid, dtype=dtype, rngs=rngs)
+    self.linear_mean = nnx.Linear(dmid, dout, dtype=dtype, rngs=rngs)
+    self.linear_logvar = nnx.Linear(dmid, dout, dtype=dtype, rngs=rngs)
+
+  def __call__(
+    self, x: jax.Array, *, rngs: nnx.Rngs
+  ) -> tuple[jax.Array, jax.Array]:
+    x = x.reshape((x.shape[0], -1)).astype(dtype)  # flatten
     x = self.linear1(x)
     x = jax.nn.relu(x)
 
     mean = self.linear_mean(x)
-    std = jnp.exp(self.linear_std(x))
-
-    self.kl_loss = Loss(
-      jnp.mean(
-        0.5 * jnp.mean(-jnp.log(std**2) - 1.0 + std**2 + mean**2, axis=-1)
+    logvar = self.linear_logvar(x)
+
+    kl_loss = jnp.mean(
+      0.5
+      * jnp.mean(
+        jnp.exp(logvar) + mean**2 - 1.0 - logvar,
+        axis=-1,
+        dtype=jnp.float32,
       )
     )
     key = rngs.noise()
-    z = mean + std * jax.random.normal(key, mean.shape)
-    return z
+    std = jnp.exp(0.5 * logvar)
+    z = mean + std * jax.random.normal(key, mean.shape, dtype=dtype)
+    return z, kl_loss
 
 
 class Decoder(nnx.Module):
   def __init__(self, din: int, dmid: int, dout: int, *, rngs: nnx.Rngs):
-    self.linear1 = nnx.Linear(din, dmid, rngs=rngs)
-    self.linear2 = nnx.Linear(dmid, dout, rngs=rngs)
+    self.linear1 = nnx.Linear(din, dmid, dtype=dtype, rngs=rngs)
+    self.linear2 = nnx.Linear(dmid, dout, dtype=dtype, rngs=rngs)
 
   def __call__(self, z: jax.Array) -> jax.Array:
     z = self.linear1(z)
@@ -95,26 +122,29 @@ class VAE(nnx.Module):
     *,
     rngs: nnx.Rngs,
   ):
-    self.output_shape = output_shape
+    # stored as a tuple so it is hashable as a static field of the graphdef
+    self.output_shape = tuple(output_shape)
     self.encoder = Encoder(din, hidden_size, latent_size, rngs=rngs)
     self.decoder = Decoder(
       latent_size, hidden_size, int(np.prod(output_shape)), rngs=rngs
     )
 
-  def __call__(self, x: jax.Array, *, rngs: nnx.Rngs) -> jax.Array:
-    z = self.encoder(x, rngs=rngs)
+  def __call__(
+    self, x: jax.Array, *, rngs: nnx.Rngs
+  ) -> tuple[jax.Array, jax.Array]:
+    z, kl_loss = self.encoder(x, rngs=rngs)
     logits = self.decoder(z)
     logits = jnp.reshape(logits, (-1, *self.output_shape))
-    return logits
+    return logits, kl_loss
 
   def generate(self, z):
     logits = self.decoder(z)
     logits = jnp.reshape(logits, (-1, *self.output_shape))
-    return nnx.sigmoid(logits)
+    return nnx.sigmoid(logits.astype(jnp.float32))
 
 
 static, params = VAE(
-  din=int(np.prod(image_shape)),
+  din=image_size,
   hidden_size=256,
   latent_size=latent_size,
   output_shape=image_shape,
@@ -129,16 +159,31 @@ state = nnx.TrainState.create(
 
 
 # %%
+def sample_batch(data: jax.Array, key: jax.Array) -> jax.Array:
+  idxs = jax.random.randint(key, (device_batch_size,), 0, data.shape[0])
+  packed = jnp.take(data, idxs, axis=0)
+  x = jnp.unpackbits(packed, axis=1, count=image_size)
+  return x.reshape((-1, *image_shape))
+
+
 @jax.jit
-def train_step(state: nnx.TrainState[VAE], x: jax.Array, key: jax.Array):
-  def loss_fn(params: nnx.State):
-    rngs = nnx.Rngs(noise=jax.random.fold_in(key, state.step))
-    logits, (_, updates) = state.apply(params)(x, rngs=rngs)
+def train_step(
+  state: nnx.TrainState[VAE],
+  data: jax.Array,
+  batch_key: jax.Array,
+  noise_key: jax.Array,
+):
+  x = sample_batch(data, batch_key)
 
-    losses = updates.extract(Loss)
-    kl_loss = sum(jax.tree_util.tree_leaves(losses), 0.0)
-    reconstruction_loss = jnp.mean(
-      optax.sigmoid_binary_cross_entropy(logits, x)
+  def loss_fn(params: nnx.State):
+    rngs = nnx.Rngs(noise=noise_key)
+    (logits, kl_loss), _ = state.apply(params)(x, rngs=rngs)
+
+    logits = logits.astype(jnp.float32)
+    labels = x.astype(jnp.float32)
+    reconstruction_loss = -jnp.mean(
+      labels * jax.nn.log_sigmoid(logits)
+      + (1.0 - labels) * jax.nn.log_sigmoid(-logits)
     )
     # jax.debug.print("kl_loss={kl_loss}", kl_loss=kl_loss)
 
@@ -146,18 +191,33 @@ def train_step(state: nnx.TrainState[VAE], x: jax.Array, key: jax.Array):
     return loss
 
   loss, grads = jax.value_and_grad(loss_fn)(state.params)
+  # average over the per-device shards of the batch
+  loss, grads = jax.lax.pmean((loss, grads), axis_name='batch')
   state = state.apply_gradients(grads=grads)
 
   return state, loss
 
 
-@partial(jax.jit, donate_argnums=(0,))
+@partial(jax.pmap, axis_name='batch', donate_argnums=(0,))
+def train_epoch(state: nnx.TrainState[VAE], data: jax.Array, key: jax.Array):
+  def epoch_body(state: nnx.TrainState[VAE], keys: jax.Array):
+    state, loss = train_step(state, data, keys[0], keys[1])
+    return state, loss
+
+  # batch and noise keys for every step are split upfront
+  keys = jax.random.split(key, (steps_per_epoch, 2))
+  state, losses = jax.lax.scan(epoch_body, state, keys)
+  # reduce on device so only a scalar per device is copied back to the host
+  return state, jnp.mean(losses)
+
+
+@jax.jit
 def forward(
   state: nnx.TrainState[VAE], x: jax.Array, key: jax.Array
 ) -> jax.Array:
   rngs = nnx.Rngs(noise=key)
-  y_pred = state.apply('params')(x, rngs=rngs)[0]
-  return jax.nn.sigmoid(y_pred)
+  (y_pred, _), _ = state.apply('params')(x, rngs=rngs)
+  return jax.nn.sigmoid(y_pred.astype(jnp.float32))
 
 
 @jax.jit
@@ -168,16 +228,28 @@ def sample(state: nnx.TrainState[VAE], z: jax.Array) -> jax.Array:
 # %%
 key = jax.random.key(0)
 
+# compile ahead of time for the shapes used below so the first epoch
+# already runs at steady-state speed
+forward_compiled = forward.lower(
+  state, jax.ShapeDtypeStruct((5, *image_shape), jnp.uint8), key
+).compile()
+sample_compiled = sample.lower(
+  state, jax.ShapeDtypeStruct((12, latent_size), jnp.float32)
+).compile()
+
+state = jax_utils.replicate(state)
+train_epoch_compiled = train_epoch.lower(
+  state, X_train_dev, jax.random.split(key, n_devices)
+).compile()
+
 for epoch in range(epochs):
-  losses = []
-  for step in range(steps_per_epoch):
-    idxs = np.random.randint(0, len(X_train), size=(batch_size,))
-    x_batch = X_train[idxs]
+  key, epoch_key = jax.random.split(key)
+  epoch_keys = jax.random.split(epoch_key, n_devices)
+  state, loss = train_epoch_compiled(state, X_train_dev, epoch_keys)
 
-    state, loss = train_step(state, x_batch, key)
-    losses.append(np.asarray(loss))
+  print(f'Epoch {epoch} loss: {np.mean(loss)}')
 
-  print(f'Epoch {epoch} loss: {np.mean(losses)}')
+state = jax_utils.unreplicate(state)
 
 # exit()
 # %%
@@ -186,7 +258,7 @@ idxs = np.random.randint(0, len(X_test), size=(5,))
 x_sample = X_test[idxs]
 
 # get predictions
-y_pred = forward(state, x_sample, key)
+y_pred = forward_compiled(state, x_sample, key)
 
 # plot reconstruction
 figure = plt.figure(figsize=(3 * 5, 3 * 2))
@@ -203,7 +275,7 @@ plt.show()
 # %%
 # plot generative samples
 z_samples = np.random.normal(scale=1.5, size=(12, latent_size))
-samples = sample(state, z_samples)
+samples = sample_compiled(state, z_samples.astype(np.float32))
 
 figure = plt.figure(figsize=(3 * 5, 3 * 2))
 plt.title('Generative Samples')
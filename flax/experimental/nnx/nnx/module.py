@@ -272,19 +272,27 @@ class Module(graph_utils.GraphNode, metaclass=ModuleMeta):
     reduce_fn: tp.Callable[[B, A], B] = tuple_reduce,
     init_fn: tp.Callable[[], B] = tuple_init,  # type: ignore
   ) -> None:
-    if hasattr(self, name):
-      variable = getattr(self, name)
+    # read the instance dict directly to avoid attribute lookup overhead
+    module_vars = vars(self)
+    if name in module_vars:
+      variable = module_vars[name]
       if not isinstance(variable, variableslib.Variable):
         raise ValueError(
           f"Expected '{name}' to be a Variable, got {type(variable).__name__}"
         )
-      elif type(variable) != variable_type:
+      elif type(variable) is not variable_type:
         raise ValueError(
           f"Expected '{name}' to be of type '{variable_type.__name__}', "
           f"got '{type(variable).__name__}'"
         )
       variable.raw_value = reduce_fn(variable.raw_value, value)
     else:
+      # don't shadow methods, properties or class attributes
+      if hasattr(type(self), name):
+        raise ValueError(
+          f"Expected '{name}' to be a Variable, "
+          f'got {type(getattr(self, name)).__name__}'
+        )
       reduced_value = reduce_fn(init_fn(), value)
       setattr(self, name, variable_type(reduced_value))
 
@@ -334,18 +342,19 @@ class Module(graph_utils.GraphNode, metaclass=ModuleMeta):
       **attributes: The attributes to set.
     """
     remaining_attributes = set(attributes.keys())
-    if not filters:
-      filters = (True,)
     predicates = tuple(map(filterlib.to_predicate, filters))
     for path, module in self.modules():
-      for predicate in predicates:
-        if predicate(path, module):
-          for name, value in attributes.items():
-            if hasattr(module, name):
-              if name in remaining_attributes:
-                remaining_attributes.remove(name)
-              setattr(module, name, value)
-          break
+      # without filters every Module is selected
+      if predicates:
+        for predicate in predicates:
+          if predicate(path, module):
+            break
+        else:
+          continue
+      for name, value in attributes.items():
+        if hasattr(module, name):
+          remaining_attributes.discard(name)
+          setattr(module, name, value)
 
     if remaining_attributes and raise_if_not_found:
       raise ValueError(
@@ -369,13 +378,15 @@ class Module(graph_utils.GraphNode, metaclass=ModuleMeta):
 # -------------------------
 def _module_flatten(module: Module, *, with_keys: bool):
   graphdef, state = module.split()
-  key_values = sorted(state.raw_mapping.items())
-  keys = tuple(key for key, _ in key_values)
+  mapping = state.raw_mapping
+  # graphdef.attributes already has a deterministic order for a given
+  # structure, use it instead of sorting the state on every flatten
+  keys = tuple(key for key in graphdef.attributes if key in mapping)
 
   if with_keys:
-    children = tuple((jtu.DictKey(key), value) for key, value in key_values)
+    children = tuple((jtu.DictKey(key), mapping[key]) for key in keys)
   else:
-    children = tuple(value for _, value in key_values)
+    children = tuple(mapping[key] for key in keys)
 
   return children, (keys, graphdef)
 
@@ -399,6 +410,9 @@ def first_from(*args: tp.Optional[A], error_msg: str) -> A:
   Returns:
     The first non-None argument.
   """
+  # fast path, the first argument is usually the one that is set
+  if args and args[0] is not None:
+    return args[0]
   for arg in args:
     if arg is not None:
       return arg
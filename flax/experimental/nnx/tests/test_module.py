@@ -269,6 +269,20 @@ class TestModule:
     with pytest.raises(ValueError, match='to be a Variable, got'):
       m(2)
 
+  def test_sow_method_name(self):
+    class Foo(nnx.Module):
+      def __call__(self, x):
+        y = x + 1
+        self.sow(nnx.Intermediate, 'modules', y)
+        return y
+
+    m = Foo()
+
+    with pytest.raises(ValueError, match='to be a Variable, got method'):
+      m(2)
+
+    assert callable(m.modules)
+
   def test_sow_wrong_collection(self):
     class Foo(nnx.Module):
       def __init__(self) -> None:
@@ -480,6 +494,12 @@ class TestModule:
     assert block.dropout.deterministic == True
     assert block.batch_norm.use_running_average == False
 
+    block = Block(2, 5, rngs=nnx.Rngs(0))
+    block.set_attributes(nnx.Linear, nnx.Dropout, deterministic=True)
+    # the dropout only matches the second filter
+    assert block.dropout.deterministic == True
+    assert block.batch_norm.use_running_average == False
+
   def test_set_attribute_error(self):
     class Block(nnx.Module):
       def __init__(self, din, dout, *, rngs: nnx.Rngs):
@@ -521,6 +541,31 @@ class TestModulePytree:
     assert m.node.value == 2
     assert m.static == 1
 
+  def test_flatten_attributes_without_state(self):
+    class Empty(nnx.Module):
+      pass
+
+    class Foo(nnx.Module, experimental_pytree=True):
+      def __init__(self):
+        p = nnx.Param(1)
+        self.a = p
+        self.b = p
+        self.empty = Empty()
+        self.static = 1
+
+    m = Foo()
+
+    leaves, treedef = jax.tree_util.tree_flatten(m)
+
+    assert len(leaves) == 1
+
+    m = jax.tree_util.tree_unflatten(treedef, leaves)
+
+    assert m.a is m.b
+    assert m.a.value == 1
+    assert isinstance(m.empty, Empty)
+    assert m.static == 1
+
 
 class TestModuleDataclass:
   def test_basic(self):